@@ -3,17 +3,68 @@
 
 import os
 import csv
-import json
-import time
+import copy
+import asyncio
+import logging
+import logging.handlers
 import argparse
+import random
+import re
+import string
 import sys
-from typing import Dict, List, Any, Optional
-
-import requests
+import threading
+import concurrent.futures
+from operator import itemgetter
+from queue import SimpleQueue
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, BinaryIO, Dict, FrozenSet, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import httpx
+import orjson
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
 
 BASE = "https://api360.yandex.net"
 
+log = logging.getLogger("mass_set_signatures")
+
+# Ожидаемое время ответа API; по закону Литтла rps * RTT запросов в полёте
+# достаточно, чтобы выбрать весь бюджет --rps
+EXPECTED_RTT_S = 0.5
+
+# Общий на все задачи token bucket для исходящих запросов (создаётся в run())
+LIMITER: Optional[AsyncLimiter] = None
+
+# Адаптивный предел одновременных запросов (создаётся в run())
+ADMISSION: Optional["Admission"] = None
+
+# Скомпилированный --template (задаётся в main())
+TEMPLATE: Optional["CompiledTemplate"] = None
+
+# Журнал --state-file, открытый на дозапись (открывается в run())
+STATE_FILE: Optional[BinaryIO] = None
+
+# Сколько успешных ответов подряд нужно, чтобы поднять предел на 1
+ADMISSION_GROW_AFTER = 20
+
+# Групп строк в одной пачке, передаваемой из потока чтения в event loop
+CSV_BATCH_SIZE = 256
+
+# Буфер чтения CSV-файла
+CSV_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Поля строки CSV как есть (без strip): сначала ROW_FIELDS, за ними —
+# значения колонок для плейсхолдеров --template в порядке CompiledTemplate.keys
+ROW_FIELDS = ("userId", "email", "signature", "lang")
+Row = Tuple[str, ...]
+
+# Все строки CSV одного пользователя: (userId, [(номер строки, строка), ...])
+Group = Tuple[str, List[Tuple[int, Row]]]
+
+# Элемент очереди: группа или None — сигнал остановки воркеру
+GroupItem = Optional[Group]
+
 # --------------------------- CLI ---------------------------
 
 def parse_args():
@@ -31,132 +82,303 @@ def parse_args():
                    help="Fallback lang if CSV has none (default: ru)")
     p.add_argument("--merge", action="store_true",
                    help="Merge with existing signatures instead of full replace")
+    p.add_argument("--template", default=None,
+                   help="Signature template file ($column / ${column} placeholders filled from CSV columns); replaces the signature column")
     p.add_argument("--convert-newlines", action="store_true",
                    help="Convert '\\n' in signature to '<br>'")
     p.add_argument("--rps", type=float, default=4.0,
                    help="Requests per second max (default: 4)")
+    p.add_argument("--rps-window", type=float, default=1.0,
+                   help="Rate limit window seconds: up to rps * window requests may go out at once, "
+                        "so larger values allow bigger bursts; values <= 1/rps give a fully smooth rate (default: 1)")
+    p.add_argument("--concurrency", type=int, default=None,
+                   help=f"Max users processed at once (default: rps * {EXPECTED_RTT_S}s RTT, at least 1)")
     p.add_argument("--dry-run", action="store_true",
                    help="Do not send changes, just print")
     p.add_argument("--timeout", type=float, default=20.0,
                    help="HTTP timeout seconds")
+    p.add_argument("--state-file", default=None,
+                   help="JSONL progress log: one line per applied row; rows already logged as ok are skipped on the next run")
     p.add_argument("--strict-email", action="store_true",
                    help="Fail the row if CSV email does not belong to the user (otherwise warn and drop 'emails' binding)")
+    p.add_argument("--trust-email", action="store_true",
+                   help="Bind CSV email without checking it belongs to the user: saves one GET per user. Ignored with --strict-email")
     return p.parse_args()
 
+# ------------------------- logging -------------------------
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    Воркеры только кладут записи в очередь; в stdout пишет отдельный поток
+    QueueListener, так что медленный терминал/пайп не тормозит запросы.
+    """
+    q: "SimpleQueue[logging.LogRecord]" = SimpleQueue()
+    logging.basicConfig(level=logging.INFO, format="%(message)s",
+                        handlers=[logging.handlers.QueueHandler(q)])
+    # httpx на INFO пишет строку на каждый запрос
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    listener = logging.handlers.QueueListener(q, logging.StreamHandler(sys.stdout))
+    listener.start()
+    return listener
+
 # ------------------------ HTTP utils -----------------------
 
-def session_with_token(token: str, timeout: float) -> requests.Session:
-    s = requests.Session()
-    s.headers.update({
-        "Authorization": f"OAuth {token}",
-        "Content-Type": "application/json; charset=utf-8",
-        "Accept": "application/json",
-    })
-    s.request = _wrap_with_timeout(s.request, timeout)
-    return s
-
-def _wrap_with_timeout(func, timeout):
-    def inner(method, url, **kwargs):
-        if "timeout" not in kwargs:
-            kwargs["timeout"] = timeout
-        return func(method, url, **kwargs)
-    return inner
-
-def backoff_request(session: requests.Session, method: str, url: str, **kwargs) -> requests.Response:
+def client_with_token(token: str, timeout: float) -> httpx.AsyncClient:
+    # HTTP/2: все параллельные запросы идут потоками по одному TLS-соединению
+    return httpx.AsyncClient(
+        base_url=BASE,
+        headers={
+            "Authorization": f"OAuth {token}",
+            "Content-Type": "application/json; charset=utf-8",
+            "Accept": "application/json",
+        },
+        http2=True,
+        timeout=timeout,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+    )
+
+class Admission:
+    """
+    Ограничитель одновременных запросов с изменяемой ёмкостью.
+    На каждую волну 429 предел снижается на 25% (но не ниже 1); после
+    ADMISSION_GROW_AFTER успешных ответов подряд растёт на 1 до исходного.
+    Уже выполняющиеся запросы не прерываются: при снижении новые просто
+    ждут, пока active не опустится ниже нового предела.
+
+    Запросы, ушедшие вместе, получают 429 тоже вместе, поэтому предел
+    снижается один раз на волну: каждое снижение начинает новую эпоху,
+    а 429 на запросы, допущенные в прошлых эпохах, не учитываются.
+    """
+
+    def __init__(self, limit: int):
+        self.initial = limit
+        self.cmax = limit
+        self.active = 0
+        self.successes = 0
+        self.epoch = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self) -> int:
+        """Занимает слот; возвращает эпоху, которую нужно передать в release()."""
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.active < self.cmax)
+            self.active += 1
+            return self.epoch
+
+    async def release(self, epoch: int, status: Optional[int]) -> None:
+        """Освобождает слот; status — код ответа или None, если запрос не удался."""
+        async with self.cond:
+            self.active -= 1
+            wake = 1
+            if status == 429:
+                self.successes = 0
+                if epoch == self.epoch:
+                    new = max(1, int(self.cmax * 0.75))
+                    if new < self.cmax:
+                        self.cmax = new
+                        self.epoch += 1
+                        log.warning(f"[THROTTLE] 429 from API: concurrency lowered to {self.cmax}")
+            elif status is not None and 200 <= status < 300:
+                self.successes += 1
+                if self.successes >= ADMISSION_GROW_AFTER and self.cmax < self.initial:
+                    self.successes = 0
+                    self.cmax += 1
+                    # появилось место ещё для одного ожидающего
+                    wake = 2
+            self.cond.notify(wake)
+
+def retry_after_seconds(resp: httpx.Response) -> Optional[float]:
+    """
+    Значение заголовка Retry-After в секундах.
+    Поддерживаются оба формата: число секунд и HTTP-дата.
+    Возвращает None, если заголовка нет или он не разбирается.
+    """
+    ra = (resp.headers.get("Retry-After") or "").strip()
+    if not ra:
+        return None
+    try:
+        return max(0.0, float(ra))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(ra)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+async def backoff_request(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
     retriable = {429, 500, 502, 503, 504}
-    last = None
-    for attempt in range(1, 7):
-        resp = session.request(method, url, **kwargs)
+    attempts = 6
+    for attempt in range(1, attempts + 1):
+        # каждая попытка, включая повторы, расходует общий бюджет --rps
+        epoch = await ADMISSION.acquire()
+        status: Optional[int] = None
+        try:
+            async with LIMITER:
+                resp = await client.request(method, url, **kwargs)
+            status = resp.status_code
+        finally:
+            await ADMISSION.release(epoch, status)
         if resp.status_code in retriable:
-            wait = min(30.0, 0.5 * (2 ** (attempt - 1)))
-            time.sleep(wait)
-            last = resp
+            if attempt == attempts:
+                break  # повторов больше не будет — ждать незачем
+            wait = retry_after_seconds(resp) if resp.status_code in (429, 503) else None
+            if wait is None:
+                # jitter разводит повторы параллельных воркеров во времени
+                cap = min(30.0, 0.5 * (2 ** (attempt - 1)))
+                wait = random.uniform(cap / 2, cap)
+            await asyncio.sleep(wait)
             continue
         return resp
-    return last if last is not None else resp
+    # все попытки исчерпаны — отдаём последний ответ как есть
+    return resp
 
 # ------------------------ API calls ------------------------
 
-def get_user(session: requests.Session, org_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+async def get_user(client: httpx.AsyncClient, org_id: str, user_id: str) -> Optional[Dict[str, Any]]:
     """
     Получить карточку пользователя:
     /directory/v1/org/{orgId}/users/{userId}
     Возвращает None, если 404.
     """
-    url = f"{BASE}/directory/v1/org/{org_id}/users/{user_id}"
-    r = backoff_request(session, "GET", url)
+    r = await backoff_request(client, "GET", f"/directory/v1/org/{org_id}/users/{user_id}")
     if r.status_code == 404:
         return None
     r.raise_for_status()
     return r.json()
 
-def user_owns_email(user: Dict[str, Any], email: str) -> bool:
+def _owned_emails(user: Dict[str, Any]) -> FrozenSet[str]:
     """
-    Проверяет, что email принадлежит пользователю:
+    Все адреса пользователя в нижнем регистре:
     - основной email (user['email'])
-    - алиасы (user['aliases'] или user['emails'] если присутствуют)
-    Сравнение регистронезависимое.
+    - алиасы (user['aliases'], user['emails'], user['alternateEmails'] если присутствуют)
+    Считается один раз и запоминается в самой карточке под ключом '_owned'.
     """
-    if not email:
-        return False
-    needle = email.strip().lower()
+    owned = user.get("_owned")
+    if owned is not None:
+        return owned
 
-    # основной
+    addrs = set()
     primary = (user.get("email") or "").strip().lower()
-    if primary and primary == needle:
-        return True
+    if primary:
+        addrs.add(primary)
 
     # возможные коллекции алиасов в разных инсталляциях
     for key in ("aliases", "emails", "alternateEmails"):
         maybe = user.get(key)
         if isinstance(maybe, list):
             for e in maybe:
-                if isinstance(e, str) and e.strip().lower() == needle:
-                    return True
-                if isinstance(e, dict):
+                if isinstance(e, str):
+                    addrs.add(e.strip().lower())
+                elif isinstance(e, dict):
                     # иногда элементы бывают словарями: {"address":"...","type":"alias"}
-                    addr = (e.get("address") or "").strip().lower()
-                    if addr == needle:
-                        return True
+                    addrs.add((e.get("address") or "").strip().lower())
+    addrs.discard("")
 
-    return False
+    owned = frozenset(addrs)
+    user["_owned"] = owned
+    return owned
 
-def get_sender_info(session: requests.Session, org_id: str, user_id: str) -> Dict[str, Any]:
-    url = f"{BASE}/admin/v1/org/{org_id}/mail/users/{user_id}/settings/sender_info"
-    r = backoff_request(session, "GET", url)
+def user_owns_email(user: Dict[str, Any], email: str) -> bool:
+    """
+    Проверяет, что email принадлежит пользователю (основной ящик или алиас).
+    Сравнение регистронезависимое.
+    """
+    if not email:
+        return False
+    return email.strip().lower() in _owned_emails(user)
+
+async def get_sender_info(client: httpx.AsyncClient, org_id: str, user_id: str) -> Dict[str, Any]:
+    r = await backoff_request(client, "GET", f"/admin/v1/org/{org_id}/mail/users/{user_id}/settings/sender_info")
     if r.status_code == 404:
         return {"signs": [], "signPosition": "bottom"}
     r.raise_for_status()
     return r.json()
 
-def post_sender_info(session: requests.Session, org_id: str, user_id: str, body: Dict[str, Any]) -> requests.Response:
-    url = f"{BASE}/admin/v1/org/{org_id}/mail/users/{user_id}/settings/sender_info"
-    return backoff_request(session, "POST", url, data=json.dumps(body, ensure_ascii=False))
+async def post_sender_info(client: httpx.AsyncClient, org_id: str, user_id: str, body: Dict[str, Any]) -> httpx.Response:
+    # orjson сразу отдаёт UTF-8 bytes: кириллица уходит как есть, без \uXXXX
+    return await backoff_request(client, "POST", f"/admin/v1/org/{org_id}/mail/users/{user_id}/settings/sender_info",
+                                 content=orjson.dumps(body))
 
 # --------------------- business logic ----------------------
 
+# литерал "\n" или настоящий перевод строки — за один проход
+_NL_RE = re.compile(r"\\n|\n")
+
 def normalize_signature(text: str, convert_newlines: bool) -> str:
     if convert_newlines:
-        return text.replace("\\n", "<br>").replace("\n", "<br>")
+        return _NL_RE.sub("<br>", text)
     return text
 
+class CompiledTemplate(NamedTuple):
+    """
+    Шаблон подписи, заранее разбитый на литералы и плейсхолдеры:
+    parts[0] + v[0] + parts[1] + v[1] + ... + parts[-1], len(parts) == len(keys) + 1.
+    """
+    parts: Tuple[str, ...]
+    keys: Tuple[str, ...]
+
+def compile_template(text: str) -> CompiledTemplate:
+    """
+    Разбирает шаблон в синтаксисе string.Template ($name, ${name}, $$ — знак $)
+    один раз, чтобы на каждую строку CSV оставался только "".join.
+    """
+    parts: List[str] = []
+    keys: List[str] = []
+    literal: List[str] = []
+    pos = 0
+    for m in string.Template.pattern.finditer(text):
+        literal.append(text[pos:m.start()])
+        pos = m.end()
+        key = m.group("named") or m.group("braced")
+        if key is None:
+            # $$ или одиночный $ без имени — остаются литералом
+            literal.append("$" if m.group("escaped") is not None else m.group(0))
+            continue
+        parts.append("".join(literal))
+        keys.append(key)
+        literal = []
+    literal.append(text[pos:])
+    parts.append("".join(literal))
+    return CompiledTemplate(tuple(parts), tuple(keys))
+
+def render_template(tmpl: CompiledTemplate, values: Sequence[str], convert_newlines: bool) -> str:
+    # литералы шаблона нормализованы при загрузке, здесь — только подставляемые значения
+    out = [tmpl.parts[0]]
+    for value, literal in zip(values, tmpl.parts[1:]):
+        out.append(normalize_signature(value.strip(), convert_newlines))
+        out.append(literal)
+    return "".join(out)
+
+def parse_row(row: Row, default_lang: str) -> Tuple[str, str, str, str]:
+    """Нормализованные (userId, email, signature, lang) строки CSV."""
+    user_id, email, text, lang = row[:len(ROW_FIELDS)]
+    # как и раньше, --default-lang нормализуется так же, как lang из CSV
+    return user_id.strip(), email.strip(), text.strip(), (lang.strip() or default_lang).strip().lower() or default_lang
+
+def row_key(row: Row, default_lang: str) -> Tuple[str, str, str]:
+    """Ключ дедупликации строк CSV: (userId, lang, email) в том виде, в каком их применит prepare_row."""
+    user_id, email, _, lang = parse_row(row, default_lang)
+    return user_id, lang, email.lower()
+
 def upsert_sign(signs: List[Dict[str, Any]], lang: str, email: str, text: str, make_default=True) -> List[Dict[str, Any]]:
+    # один проход: индекс (lang, emails) -> позиция и индексы подписей по lang
+    index: Dict[Tuple[Any, Tuple[str, ...]], int] = {}
+    by_lang: Dict[Any, List[int]] = {}
+    for i, s in enumerate(signs):
+        s_lang = s.get("lang")
+        index.setdefault((s_lang, tuple(sorted(s.get("emails") or ()))), i)
+        by_lang.setdefault(s_lang, []).append(i)
+
     # снять default у остальных с тем же lang
     if make_default:
-        for s in signs:
-            if s.get("lang") == lang:
-                s["isDefault"] = False
+        for i in by_lang.get(lang, ()):
+            signs[i]["isDefault"] = False
 
     # найти существующую подпись с тем же lang и той же привязкой emails
-    target_idx = None
-    for i, s in enumerate(signs):
-        if s.get("lang") != lang:
-            continue
-        cur_emails = sorted(s.get("emails", []))
-        want_emails = sorted([email]) if email else []
-        if cur_emails == want_emails:
-            target_idx = i
-            break
+    target_idx = index.get((lang, (email,) if email else ()))
 
     new_entry = {"text": text, "lang": lang, "isDefault": bool(make_default)}
     if email:
@@ -171,6 +393,320 @@ def upsert_sign(signs: List[Dict[str, Any]], lang: str, email: str, text: str, m
 
 # --------------------------- main --------------------------
 
+async def prepare_row(client: httpx.AsyncClient, args, idx: int, row: Row,
+                      users: Dict[str, Optional[Dict[str, Any]]]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+    """
+    Проверяет строку CSV и готовит подпись к применению.
+    users — карточки пользователей, уже полученные для этой группы строк.
+    Возвращает (None, {"lang", "email", "text"}), если строку нужно применить,
+    иначе (итог для --state-file, None): "fail" или None при пропуске.
+    """
+    user_id, csv_email, text, lang = parse_row(row, args.default_lang)
+    if TEMPLATE is not None:
+        text = render_template(TEMPLATE, row[len(ROW_FIELDS):], args.convert_newlines)
+    else:
+        text = normalize_signature(text, args.convert_newlines)
+
+    if not user_id or not text:
+        log.info(f"[SKIP] row={idx}: missing userId or signature")
+        return None, None
+
+    # Проверка владельца email (если указан)
+    email_to_bind: Optional[str] = None
+    if csv_email and args.trust_email and not args.strict_email:
+        # CSV уже проверен вызывающим — GET карточки не нужен
+        email_to_bind = csv_email
+    elif csv_email:
+        if user_id not in users:
+            users[user_id] = await get_user(client, args.org_id, user_id)
+        user = users[user_id]
+        if user is None:
+            msg = f"[FAIL] userId={user_id}: user not found (404)"
+            if args.strict_email:
+                log.error(msg)
+                return "fail", None
+            else:
+                log.warning(msg + " — drop email binding, proceed without 'emails'")
+        else:
+            if user_owns_email(user, csv_email):
+                email_to_bind = csv_email
+            else:
+                msg = f"[{'FAIL' if args.strict_email else 'WARN'}] userId={user_id}: email '{csv_email}' does not belong to user"
+                if args.strict_email:
+                    log.error(msg)
+                    return "fail", None
+                else:
+                    log.warning(msg + " — drop email binding, proceed without 'emails'")
+
+    return None, {"lang": lang, "email": email_to_bind, "text": text}
+
+async def send_sender_info(client: httpx.AsyncClient, args, user_id: str, body: Dict[str, Any]) -> Optional[str]:
+    """POST готового тела (или печать при --dry-run). Возвращает "ok", "fail" или None для --dry-run."""
+    if args.dry_run:
+        log.info(f"[DRY] userId={user_id} body={orjson.dumps(body).decode()}")
+        return None
+
+    resp = await post_sender_info(client, args.org_id, user_id, body)
+    if resp.status_code == 200:
+        log.info(f"[OK ] userId={user_id}")
+        return "ok"
+    log.error(f"[FAIL] userId={user_id} status={resp.status_code} body={resp.text}")
+    return "fail"
+
+async def process_user(client: httpx.AsyncClient, args, user_id: str, items: List[Tuple[int, Row]]) -> List[Tuple[int, Row, Optional[str]]]:
+    """
+    Применяет все строки CSV одного пользователя. Возвращает (номер, строка, итог)
+    для --state-file, итог — "ok", "fail" или None.
+
+    В режиме merge все подписи пользователя собираются в один GET + один POST:
+    это и вдвое меньше запросов на строку, и нет гонки, когда параллельные
+    POST по одному пользователю затирают друг друга. При полной замене строки
+    применяются по очереди, как и раньше: в итоге остаётся последняя.
+    """
+    results: List[Tuple[int, Row, Optional[str]]] = []
+    pending: List[Tuple[int, Row, Dict[str, Any]]] = []
+    # карточка запрашивается один раз на группу, даже если строк несколько
+    users: Dict[str, Optional[Dict[str, Any]]] = {}
+    for idx, row in items:
+        status, sign = await prepare_row(client, args, idx, row, users)
+        if sign is None:
+            results.append((idx, row, status))
+        else:
+            pending.append((idx, row, sign))
+    if not pending:
+        return results
+
+    if not args.merge:
+        # Полная замена — одна дефолтная подпись
+        for idx, row, sign in pending:
+            one = {"text": sign["text"], "lang": sign["lang"], "isDefault": True}
+            if sign["email"]:
+                one["emails"] = [sign["email"]]
+            body = {"signs": [one], "signPosition": args.position}
+            results.append((idx, row, await send_sender_info(client, args, user_id, body)))
+        return results
+
+    # GET текущие и апдейт
+    try:
+        current = await get_sender_info(client, args.org_id, user_id)
+    except httpx.HTTPStatusError as e:
+        log.error(f"[FAIL][{user_id}] GET sender_info: {e}")
+        return results + [(idx, row, "fail") for idx, row, _ in pending]
+
+    current_signs = current.get("signs", [])
+    signs = copy.deepcopy(current_signs)
+    for _, _, sign in pending:
+        upsert_sign(signs, lang=sign["lang"], email=sign["email"], text=sign["text"], make_default=True)
+    body = {"signs": signs, "signPosition": current.get("signPosition") or args.position}
+    # подписи уже в нужном состоянии — POST не нужен
+    if signs == current_signs and body["signPosition"] == current.get("signPosition"):
+        log.info(f"[SKIP-NOOP] userId={user_id}: signature already up to date")
+        post_status: Optional[str] = "ok"
+    else:
+        post_status = await send_sender_info(client, args, user_id, body)
+    return results + [(idx, row, post_status) for idx, row, _ in pending]
+
+# ------------------------ state file -----------------------
+
+def load_state(path: str) -> Set[Tuple[str, str, str]]:
+    """
+    Ключи строк (userId, lang, email), уже применённых в прошлых прогонах
+    (status == "ok" в --state-file). Битые строки (например, недописанная
+    последняя при аварийном завершении) пропускаются; open_state() закрывает
+    такую строку переводом строки, чтобы новые записи не приклеились к ней.
+    """
+    done: Set[Tuple[str, str, str]] = set()
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return done
+    with f:
+        for line in f:
+            try:
+                rec = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            if isinstance(rec, dict) and rec.get("status") == "ok":
+                done.add((rec.get("userId", ""), rec.get("lang", ""), rec.get("email", "")))
+    return done
+
+def open_state(path: str) -> BinaryIO:
+    """Открывает --state-file на дозапись так, чтобы новая запись начиналась с новой строки."""
+    f = open(path, "ab")
+    if f.tell() > 0:
+        with open(path, "rb") as r:
+            r.seek(-1, os.SEEK_END)
+            torn = r.read(1) != b"\n"
+        if torn:
+            f.write(b"\n")
+            f.flush()
+    return f
+
+def record_state(idx: int, row: Row, default_lang: str, status: str) -> None:
+    # Запись синхронная и без await, поэтому строки от разных воркеров
+    # не перемешиваются: event loop однопоточный, отдельный lock не нужен.
+    user_id, lang, email = row_key(row, default_lang)
+    STATE_FILE.write(orjson.dumps({"row": idx, "userId": user_id, "lang": lang,
+                                   "email": email, "status": status}) + b"\n")
+    STATE_FILE.flush()
+
+
+def _iter_rows(f, fields: Sequence[str]) -> Iterator[Tuple[int, Row]]:
+    """
+    Строки CSV как кортежи значений колонок fields. Вместо DictReader — csv.reader и
+    индексы колонок, вычисленные один раз по заголовку: без словаря на строку.
+    Отсутствующая колонка lang и недостающие в строке поля дают "".
+    """
+    # каждый проход — с начала файла, заголовок читается заново
+    f.seek(0)
+    reader = csv.reader(f)
+    header = [h.strip() for h in next(reader, [])]
+    width = len(header)
+    cols = [header.index(name) if name in header else width for name in fields]
+    need = max(cols) + 1
+    get = itemgetter(*cols)
+    idx = 0
+    for raw in reader:
+        if not raw:
+            continue  # пустые строки DictReader тоже пропускал
+        idx += 1
+        if len(raw) < need:
+            raw += [""] * (need - len(raw))
+        yield idx, get(raw)
+
+def _read_rows_blocking(f, fields: Sequence[str], default_lang: str, done: Set[Tuple[str, str, str]], put_batch, stop: threading.Event) -> None:
+    """
+    Выполняется в отдельном потоке: разбирает CSV и передаёт в event loop
+    группы строк по пользователям пачками по CSV_BATCH_SIZE групп.
+    put_batch(batch) возвращает concurrent Future, который завершается,
+    когда вся пачка легла в очередь (backpressure).
+
+    Файл читается дважды: первый проход запоминает номер последней строки
+    для каждого (userId, lang, email) и число таких строк у пользователя,
+    второй отдаёт только эти строки. Группа пользователя уходит, как только
+    встретилась его последняя строка, поэтому в памяти держатся лишь ключи
+    и строки пользователей, чьи группы ещё не собраны. Строки, ключи которых
+    есть в done (уже применены по --state-file), не отдаются.
+    """
+    last: Dict[Tuple[str, str, str], int] = {}
+    total = 0
+    for idx, row in _iter_rows(f, fields):
+        last[row_key(row, default_lang)] = idx
+        total += 1
+    if total > len(last):
+        log.info(f"[DEDUP] {total - len(last)} duplicate rows skipped (last row per userId,lang,email wins)")
+
+    left: Dict[str, int] = {}
+    resumed = 0
+    for key in last:
+        if key in done:
+            resumed += 1
+        else:
+            left[key[0]] = left.get(key[0], 0) + 1
+    if resumed:
+        log.info(f"[RESUME] {resumed} rows already applied according to state file, skipped")
+
+    pending: Dict[str, List[Tuple[int, Row]]] = {}
+    batch: List[Group] = []
+    for idx, row in _iter_rows(f, fields):
+        key = row_key(row, default_lang)
+        if last[key] != idx or key in done:
+            continue
+        user_id = key[0]
+        items = pending.setdefault(user_id, [])
+        items.append((idx, row))
+        if len(items) < left[user_id]:
+            continue
+        del pending[user_id]
+        batch.append((user_id, items))
+        if len(batch) >= CSV_BATCH_SIZE:
+            if not _wait_batch(put_batch(batch), stop):
+                return
+            batch = []
+    if batch:
+        _wait_batch(put_batch(batch), stop)
+
+def _wait_batch(fut: "concurrent.futures.Future[None]", stop: threading.Event) -> bool:
+    # ждём с таймаутом, чтобы поток не повис, если прогон прерван (Ctrl-C)
+    while True:
+        try:
+            fut.result(timeout=0.5)
+            return True
+        except concurrent.futures.TimeoutError:
+            if stop.is_set():
+                fut.cancel()
+                return False
+
+async def read_rows(f, fields: Sequence[str], default_lang: str, done: Set[Tuple[str, str, str]], queue: "asyncio.Queue[GroupItem]", workers: int) -> None:
+    """
+    Producer: CSV разбирается в отдельном потоке, event loop только раскладывает
+    готовые пачки групп (userId, [(номер, строка), ...]) по очереди.
+    По окончании отправляет по одному None каждому воркеру.
+    """
+    loop = asyncio.get_running_loop()
+    stop = threading.Event()
+
+    async def put_all(batch: List[Group]) -> None:
+        for item in batch:
+            await queue.put(item)
+
+    def put_batch(batch: List[Group]) -> "concurrent.futures.Future[None]":
+        return asyncio.run_coroutine_threadsafe(put_all(batch), loop)
+
+    try:
+        await asyncio.to_thread(_read_rows_blocking, f, fields, default_lang, done, put_batch, stop)
+    finally:
+        stop.set()
+    for _ in range(workers):
+        await queue.put(None)
+
+async def worker(client: httpx.AsyncClient, args, queue: "asyncio.Queue[GroupItem]") -> None:
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+        user_id, items = item
+        try:
+            results = await process_user(client, args, user_id, items)
+        except httpx.HTTPError as e:
+            # сбой сети или неожиданный HTTP-статус не должен останавливать
+            # остальных воркеров: пользователь помечается fail и будет
+            # повторён при следующем запуске с --state-file
+            log.error(f"[FAIL] userId={user_id}: {type(e).__name__}: {e}")
+            results = [(idx, row, "fail") for idx, row in items]
+        for idx, row, status in results:
+            if status is not None and STATE_FILE is not None:
+                record_state(idx, row, args.default_lang, status)
+
+async def run(args, f) -> None:
+    global LIMITER, ADMISSION, STATE_FILE
+    rps = max(args.rps, 0.1)
+    # Ёмкость ведра rps * window — столько запросов может уйти залпом.
+    # Минимум — один запрос (иначе acquire() падает): AsyncLimiter(1, 1/rps)
+    # означает ровный поток без всплесков.
+    window = max(args.rps_window, 1.0 / rps)
+    LIMITER = AsyncLimiter(rps * window, window)
+    # Одновременно обрабатывается не больше --concurrency пользователей: столько
+    # воркеров разбирают очередь. Число запросов в полёте дополнительно подстраивает
+    # Admission — при лавине 429 оно падает ниже --concurrency.
+    ADMISSION = Admission(args.concurrency)
+    queue: "asyncio.Queue[GroupItem]" = asyncio.Queue(maxsize=2 * args.concurrency)
+    fields = ROW_FIELDS + (TEMPLATE.keys if TEMPLATE is not None else ())
+    done: Set[Tuple[str, str, str]] = set()
+    if args.state_file:
+        done = load_state(args.state_file)
+        STATE_FILE = open_state(args.state_file)
+    try:
+        async with client_with_token(args.token, args.timeout) as client:
+            await asyncio.gather(
+                read_rows(f, fields, args.default_lang, done, queue, args.concurrency),
+                *(worker(client, args, queue) for _ in range(args.concurrency)),
+            )
+    finally:
+        if STATE_FILE is not None:
+            STATE_FILE.close()
+            STATE_FILE = None
+
 def main():
     load_dotenv()  # загрузить .env
 
@@ -180,90 +716,35 @@ def main():
         sys.exit("Укажите --org-id или переменную окружения ORG_ID (в .env)")
     if not args.token:
         sys.exit("Укажите --token или переменную окружения TOKEN (в .env)")
-
-    sess = session_with_token(args.token, args.timeout)
-    interval = 1.0 / max(args.rps, 0.1)
-
-    # читаем CSV
-    with open(args.csv, "r", encoding="utf-8-sig", newline="") as f:
+    if args.concurrency is None:
+        args.concurrency = max(1, int(args.rps * EXPECTED_RTT_S))
+    elif args.concurrency < 1:
+        sys.exit("--concurrency должен быть не меньше 1")
+    if args.rps_window <= 0:
+        sys.exit("--rps-window должен быть больше 0")
+
+    global TEMPLATE
+    if args.template:
+        with open(args.template, "r", encoding="utf-8-sig") as tf:
+            # литералы нормализуем один раз здесь, а не на каждой строке
+            TEMPLATE = compile_template(normalize_signature(tf.read().strip(), args.convert_newlines))
+
+    # CSV читается потоково, параллельно с запросами к API
+    with open(args.csv, "r", encoding="utf-8-sig", newline="", buffering=CSV_BUFFER_SIZE) as f:
         reader = csv.DictReader(f)
         if not reader.fieldnames:
             sys.exit("CSV пустой или без заголовка. Нужны колонки: userId,email,signature[,lang]")
         headers = [h.strip() for h in reader.fieldnames]
-        missing = {"userId", "email", "signature"} - set(headers)
+        required = {"userId", "email"} | (set(TEMPLATE.keys) if TEMPLATE is not None else {"signature"})
+        missing = required - set(headers)
         if missing:
-            sys.exit(f"В CSV не хватает колонок: {', '.join(missing)}")
-
-        rows = []
-        for raw in reader:
-            row = {k.strip(): (v if v is not None else "") for k, v in raw.items()}
-            rows.append(row)
-
-    for idx, row in enumerate(rows, start=1):
-        user_id = (row.get("userId") or "").strip()
-        csv_email = (row.get("email") or "").strip()
-        text = (row.get("signature") or "").strip()
-        lang = (row.get("lang") or args.default_lang).strip().lower() or args.default_lang
-
-        if not user_id or not text:
-            print(f"[SKIP] row={idx}: missing userId or signature")
-            continue
-
-        # Проверка владельца email (если указан)
-        email_to_bind: Optional[str] = None
-        if csv_email:
-            user = get_user(sess, args.org_id, user_id)
-            if user is None:
-                msg = f"[FAIL] userId={user_id}: user not found (404)"
-                if args.strict_email:
-                    print(msg)
-                    time.sleep(interval)
-                    continue
-                else:
-                    print(msg + " — drop email binding, proceed without 'emails'")
-            else:
-                if user_owns_email(user, csv_email):
-                    email_to_bind = csv_email
-                else:
-                    msg = f"[{'FAIL' if args.strict_email else 'WARN'}] userId={user_id}: email '{csv_email}' does not belong to user"
-                    if args.strict_email:
-                        print(msg)
-                        time.sleep(interval)
-                        continue
-                    else:
-                        print(msg + " — drop email binding, proceed without 'emails'")
-
-        text_norm = normalize_signature(text, args.convert_newlines)
-
-        if args.merge:
-            # GET текущие и апдейт
-            try:
-                current = get_sender_info(sess, args.org_id, user_id)
-            except requests.HTTPError as e:
-                print(f"[FAIL][{user_id}] GET sender_info: {e}")
-                time.sleep(interval)
-                continue
-
-            signs = current.get("signs", [])
-            signs = upsert_sign(signs, lang=lang, email=email_to_bind, text=text_norm, make_default=True)
-            body = {"signs": signs, "signPosition": current.get("signPosition") or args.position}
-        else:
-            # Полная замена — одна дефолтная подпись
-            one = {"text": text_norm, "lang": lang, "isDefault": True}
-            if email_to_bind:
-                one["emails"] = [email_to_bind]
-            body = {"signs": [one], "signPosition": args.position}
-
-        if args.dry_run:
-            print(f"[DRY] userId={user_id} body={json.dumps(body, ensure_ascii=False)}")
-        else:
-            resp = post_sender_info(sess, args.org_id, user_id, body)
-            if resp.status_code == 200:
-                print(f"[OK ] userId={user_id}")
-            else:
-                print(f"[FAIL] userId={user_id} status={resp.status_code} body={resp.text}")
+            sys.exit(f"В CSV не хватает колонок: {', '.join(sorted(missing))}")
 
-        time.sleep(interval)
+        listener = setup_logging()
+        try:
+            asyncio.run(run(args, f))
+        finally:
+            listener.stop()  # дописать всё, что осталось в очереди
 
 if __name__ == "__main__":
     main()